@@ -3,204 +3,248 @@ Vulnerabilities API endpoints
 """
 
 from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import desc, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, load_only, raiseload, selectinload
+from typing import List, Literal, Optional
 from datetime import datetime, timedelta
+import time
 
-from core.database import get_db, Vulnerability, Device, ScanSession
-from api.schemas.vulnerability import VulnerabilityResponse, VulnerabilityListResponse
+from core.database import (
+    get_db,
+    Vulnerability,
+    VulnerabilityStatsHourly,
+    Device,
+    ScanSession
+)
+from api.schemas.vulnerability import (
+    VulnerabilityResponse,
+    VulnerabilityListResponse,
+    vuln_to_dict
+)
 
-router = APIRouter()
+# orjson serializes large responses several times faster than json.dumps and
+# handles datetimes natively
+router = APIRouter(default_response_class=ORJSONResponse)
+
+# Declaring severity as a Literal lets FastAPI reject invalid values during
+# request parsing (422) instead of checking membership in the handler
+Severity = Literal["info", "low", "medium", "high", "critical"]
+
+# Response ordering for severity-grouped output, most severe first
+SEVERITY_LEVELS = ("critical", "high", "medium", "low", "info")
+
+# Columns needed to build a VulnerabilityResponse; load_only with these keeps
+# the remaining columns out of the SELECT list
+RESPONSE_COLUMNS = (
+    Vulnerability.id,
+    Vulnerability.cve_id,
+    Vulnerability.title,
+    Vulnerability.description,
+    Vulnerability.severity,
+    Vulnerability.cvss_score,
+    Vulnerability.source_tool,
+    Vulnerability.detected_at,
+    Vulnerability.affected_port,
+    Vulnerability.affected_service,
+    Vulnerability.solution,
+    Vulnerability.references,
+    Vulnerability.device_id,
+    Vulnerability.scan_session_id
+)
 
 @router.get("/", response_model=VulnerabilityListResponse)
 async def get_vulnerabilities(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     device_id: Optional[str] = Query(None, description="Filter by device ID"),
     scan_session_id: Optional[str] = Query(None, description="Filter by scan session ID"),
-    severity: Optional[str] = Query(None, description="Filter by severity"),
+    severity: Optional[Severity] = Query(None, description="Filter by severity"),
     source_tool: Optional[str] = Query(None, description="Filter by source tool"),
     cve_id: Optional[str] = Query(None, description="Filter by CVE ID"),
     limit: int = Query(100, le=1000, description="Maximum number of vulnerabilities"),
     offset: int = Query(0, ge=0, description="Offset for pagination")
 ):
     """Get list of vulnerabilities with optional filters"""
-    
-    query = db.query(Vulnerability)
-    
-    # Apply filters
+
+    # Build filters once so the page query and the count query share them
+    conditions = [Vulnerability.deleted_at.is_(None)]
     if device_id:
-        query = query.filter(Vulnerability.device_id == device_id)
-    
+        conditions.append(Vulnerability.device_id == device_id)
+
     if scan_session_id:
-        query = query.filter(Vulnerability.scan_session_id == scan_session_id)
-    
+        conditions.append(Vulnerability.scan_session_id == scan_session_id)
+
     if severity:
-        query = query.filter(Vulnerability.severity == severity)
-    
+        conditions.append(Vulnerability.severity == severity)
+
     if source_tool:
-        query = query.filter(Vulnerability.source_tool == source_tool)
-    
+        conditions.append(Vulnerability.source_tool == source_tool)
+
     if cve_id:
-        query = query.filter(Vulnerability.cve_id == cve_id)
-    
+        conditions.append(Vulnerability.cve_id == cve_id)
+
+    # Eager-load the device relationship in a single follow-up SELECT instead of
+    # one lazy SELECT per row; raiseload turns any other lazy access into an error
     # Order by severity (critical first) and detection time
-    query = query.order_by(
-        Vulnerability.severity_score.desc(),
-        Vulnerability.detected_at.desc()
+    result = await db.execute(
+        select(Vulnerability).options(
+            load_only(*RESPONSE_COLUMNS),
+            selectinload(Vulnerability.device).load_only(
+                Device.ip_address, Device.hostname
+            ),
+            raiseload("*")
+        ).where(*conditions).order_by(
+            Vulnerability.severity_score.desc(),
+            Vulnerability.detected_at.desc()
+        ).offset(offset).limit(limit)
     )
-    
-    # Get vulnerabilities with pagination
-    vulnerabilities = query.offset(offset).limit(limit).all()
-    total_count = query.count()
-    
-    # Convert to response model
-    vuln_responses = []
-    for vuln in vulnerabilities:
-        device_ip = vuln.device.ip_address if vuln.device else "Unknown"
-        device_hostname = vuln.device.hostname if vuln.device else None
-        
-        vuln_response = VulnerabilityResponse(
-            id=vuln.id,
-            cve_id=vuln.cve_id,
-            title=vuln.title,
-            description=vuln.description,
-            severity=vuln.severity,
-            cvss_score=vuln.cvss_score,
-            source_tool=vuln.source_tool,
-            detected_at=vuln.detected_at,
-            affected_port=vuln.affected_port,
-            affected_service=vuln.affected_service,
-            solution=vuln.solution,
-            references=vuln.reference_list,
-            device_id=vuln.device_id,
-            device_ip=device_ip,
-            device_hostname=device_hostname,
-            scan_session_id=vuln.scan_session_id
-        )
-        vuln_responses.append(vuln_response)
-    
-    return VulnerabilityListResponse(
-        vulnerabilities=vuln_responses,
-        total_count=total_count,
-        returned_count=len(vuln_responses)
+    vulnerabilities = result.scalars().all()
+
+    # Count with only the WHERE clause - no ORDER BY and no subquery wrap
+    total_count = await db.scalar(
+        select(func.count(Vulnerability.id)).where(*conditions)
     )
 
+    # Build plain dicts and hand them straight to orjson; the rows come from
+    # our own columns, so re-validating them through Pydantic buys nothing
+    vuln_dicts = [vuln_to_dict(vuln) for vuln in vulnerabilities]
+
+    return ORJSONResponse({
+        "vulnerabilities": vuln_dicts,
+        "total_count": total_count,
+        "returned_count": len(vuln_dicts)
+    })
+
 @router.get("/{vulnerability_id}", response_model=VulnerabilityResponse)
 async def get_vulnerability_detail(
     vulnerability_id: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get detailed information about a specific vulnerability"""
-    
-    vulnerability = db.query(Vulnerability).filter(Vulnerability.id == vulnerability_id).first()
+
+    vulnerability = await db.scalar(
+        select(Vulnerability).options(
+            load_only(*RESPONSE_COLUMNS),
+            joinedload(Vulnerability.device).load_only(
+                Device.ip_address, Device.hostname
+            ),
+            raiseload("*")
+        ).where(
+            Vulnerability.id == vulnerability_id,
+            Vulnerability.deleted_at.is_(None)
+        )
+    )
     if not vulnerability:
         raise HTTPException(status_code=404, detail="Vulnerability not found")
-    
-    device_ip = vulnerability.device.ip_address if vulnerability.device else "Unknown"
-    device_hostname = vulnerability.device.hostname if vulnerability.device else None
-    
-    return VulnerabilityResponse(
-        id=vulnerability.id,
-        cve_id=vulnerability.cve_id,
-        title=vulnerability.title,
-        description=vulnerability.description,
-        severity=vulnerability.severity,
-        cvss_score=vulnerability.cvss_score,
-        source_tool=vulnerability.source_tool,
-        detected_at=vulnerability.detected_at,
-        affected_port=vulnerability.affected_port,
-        affected_service=vulnerability.affected_service,
-        solution=vulnerability.solution,
-        references=vulnerability.reference_list,
-        device_id=vulnerability.device_id,
-        device_ip=device_ip,
-        device_hostname=device_hostname,
-        scan_session_id=vulnerability.scan_session_id
-    )
+
+    return VulnerabilityResponse.model_validate(vulnerability)
+
+# Short-TTL cache for the stats summary, keyed by the hours window. The data
+# changes at most every few seconds, so stale-by-30s answers are fine.
+STATS_CACHE_TTL = 30.0
+_stats_cache = {}
 
 @router.get("/stats/summary")
 async def get_vulnerability_stats(
-    db: Session = Depends(get_db),
-    hours: int = Query(24, description="Time range in hours")
+    db: AsyncSession = Depends(get_db),
+    hours: int = Query(24, ge=1, le=24 * 90, description="Time range in hours (max 90 days)")
 ):
     """Get vulnerability statistics summary"""
-    
+
+    # Dashboards poll this endpoint from every open viewer; serve a
+    # recently-computed result instead of re-aggregating on each poll
+    cached = _stats_cache.get(hours)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    # Serve from the hourly rollup instead of rescanning the vulnerabilities
+    # table; buckets are hour-truncated, so truncate the cutoff as well
     cutoff_time = datetime.utcnow() - timedelta(hours=hours)
-    
-    # Get vulnerabilities in the time range
-    recent_vulns = db.query(Vulnerability).filter(
-        Vulnerability.detected_at >= cutoff_time
-    ).all()
-    
-    # Calculate statistics
-    stats = {
-        "total_vulnerabilities": len(recent_vulns),
-        "severity_distribution": {},
-        "source_tool_distribution": {},
-        "top_cves": {},
-        "critical_vulnerabilities": len([v for v in recent_vulns if v.severity == "critical"]),
-        "high_vulnerabilities": len([v for v in recent_vulns if v.severity == "high"]),
-        "devices_affected": len(set(v.device_id for v in recent_vulns if v.device_id))
-    }
-    
+    bucket_cutoff = cutoff_time.replace(minute=0, second=0, microsecond=0)
+    in_range = VulnerabilityStatsHourly.bucket >= bucket_cutoff
+
     # Count by severity
-    for vuln in recent_vulns:
-        severity = vuln.severity
-        stats["severity_distribution"][severity] = stats["severity_distribution"].get(severity, 0) + 1
-    
+    severity_rows = await db.execute(
+        select(VulnerabilityStatsHourly.severity, func.sum(VulnerabilityStatsHourly.n))
+        .where(in_range)
+        .group_by(VulnerabilityStatsHourly.severity)
+    )
+    severity_distribution = {k: int(n) for k, n in severity_rows.all()}
+
     # Count by source tool
-    for vuln in recent_vulns:
-        tool = vuln.source_tool
-        stats["source_tool_distribution"][tool] = stats["source_tool_distribution"].get(tool, 0) + 1
-    
-    # Count top CVEs
-    for vuln in recent_vulns:
-        if vuln.cve_id:
-            stats["top_cves"][vuln.cve_id] = stats["top_cves"].get(vuln.cve_id, 0) + 1
-    
+    source_tool_rows = await db.execute(
+        select(VulnerabilityStatsHourly.source_tool, func.sum(VulnerabilityStatsHourly.n))
+        .where(in_range)
+        .group_by(VulnerabilityStatsHourly.source_tool)
+    )
+    source_tool_distribution = {k: int(n) for k, n in source_tool_rows.all()}
+
     # Get top 10 CVEs
-    stats["top_cves"] = dict(sorted(stats["top_cves"].items(), key=lambda x: x[1], reverse=True)[:10])
-    
+    top_cve_rows = await db.execute(
+        select(VulnerabilityStatsHourly.cve_id, func.sum(VulnerabilityStatsHourly.n).label("cve_count"))
+        .where(in_range, VulnerabilityStatsHourly.cve_id != "")
+        .group_by(VulnerabilityStatsHourly.cve_id)
+        .order_by(desc("cve_count"))
+        .limit(10)
+    )
+    top_cves = {k: int(n) for k, n in top_cve_rows.all()}
+
+    # One FILTER (WHERE ...) aggregate computes all four scalars in a single
+    # pass over the in-range rollup rows
+    totals = (await db.execute(
+        select(
+            func.coalesce(func.sum(VulnerabilityStatsHourly.n), 0),
+            func.coalesce(
+                func.sum(VulnerabilityStatsHourly.n)
+                .filter(VulnerabilityStatsHourly.severity == "critical"),
+                0
+            ),
+            func.coalesce(
+                func.sum(VulnerabilityStatsHourly.n)
+                .filter(VulnerabilityStatsHourly.severity == "high"),
+                0
+            ),
+            func.count(func.distinct(VulnerabilityStatsHourly.device_id))
+            .filter(VulnerabilityStatsHourly.device_id != "")
+        ).where(in_range)
+    )).one()
+    total, critical, high, devices_affected = totals
+
+    stats = {
+        "total_vulnerabilities": int(total),
+        "severity_distribution": severity_distribution,
+        "source_tool_distribution": source_tool_distribution,
+        "top_cves": top_cves,
+        "critical_vulnerabilities": int(critical),
+        "high_vulnerabilities": int(high),
+        "devices_affected": devices_affected
+    }
+    _stats_cache[hours] = (time.monotonic() + STATS_CACHE_TTL, stats)
     return stats
 
 @router.get("/severity/{severity}")
 async def get_vulnerabilities_by_severity(
-    severity: str,
-    db: Session = Depends(get_db),
+    severity: Severity,
+    db: AsyncSession = Depends(get_db),
     limit: int = Query(50, le=500, description="Maximum number of vulnerabilities")
 ):
     """Get vulnerabilities filtered by severity level"""
-    
-    valid_severities = ["info", "low", "medium", "high", "critical"]
-    if severity not in valid_severities:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid severity. Valid options: {', '.join(valid_severities)}"
-        )
-    
-    vulnerabilities = db.query(Vulnerability).filter(
-        Vulnerability.severity == severity
-    ).order_by(Vulnerability.detected_at.desc()).limit(limit).all()
-    
+
+    result = await db.execute(
+        select(Vulnerability).options(
+            selectinload(Vulnerability.device),
+            raiseload("*")
+        ).where(
+            Vulnerability.severity == severity,
+            Vulnerability.deleted_at.is_(None)
+        ).order_by(Vulnerability.detected_at.desc()).limit(limit)
+    )
+    vulnerabilities = result.scalars().all()
+
     # Convert to response format
-    results = []
-    for vuln in vulnerabilities:
-        device_info = {
-            "ip_address": vuln.device.ip_address if vuln.device else "Unknown",
-            "hostname": vuln.device.hostname if vuln.device else None
-        }
-        
-        vuln_data = {
-            "id": vuln.id,
-            "title": vuln.title,
-            "cve_id": vuln.cve_id,
-            "cvss_score": vuln.cvss_score,
-            "source_tool": vuln.source_tool,
-            "detected_at": vuln.detected_at,
-            "device": device_info
-        }
-        results.append(vuln_data)
-    
+    results = [vuln_to_dict(vuln) for vuln in vulnerabilities]
+
     return {
         "severity": severity,
         "count": len(results),
@@ -210,44 +254,64 @@ async def get_vulnerabilities_by_severity(
 @router.get("/device/{device_id}")
 async def get_device_vulnerabilities(
     device_id: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    limit: int = Query(500, le=1000, description="Maximum number of vulnerabilities"),
+    offset: int = Query(0, ge=0, description="Offset for pagination")
 ):
-    """Get all vulnerabilities for a specific device"""
-    
-    device = db.query(Device).filter(Device.id == device_id).first()
+    """Get vulnerabilities for a specific device, paged"""
+
+    # One index-backed query doubles as the existence check and fetches just
+    # the columns the response needs - no Device entity is materialized
+    device_row = await db.execute(
+        select(
+            Device.id,
+            Device.ip_address,
+            Device.hostname,
+            Device.device_type,
+            Device.risk_level
+        ).where(Device.id == device_id)
+    )
+    device = device_row.first()
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
-    
-    vulnerabilities = db.query(Vulnerability).filter(
-        Vulnerability.device_id == device_id
-    ).order_by(
-        Vulnerability.severity_score.desc(),
-        Vulnerability.detected_at.desc()
-    ).all()
-    
-    # Group by severity
-    grouped_vulns = {
-        "critical": [],
-        "high": [],
-        "medium": [],
-        "low": [],
-        "info": []
-    }
-    
+
+    # A device can have tens of thousands of findings; page the rows instead
+    # of materializing them all, and take the summary from a GROUP BY so it
+    # still covers the whole device
+    summary_rows = await db.execute(
+        select(Vulnerability.severity, func.count())
+        .where(
+            Vulnerability.device_id == device_id,
+            Vulnerability.deleted_at.is_(None)
+        )
+        .group_by(Vulnerability.severity)
+    )
+    severity_counts = dict(summary_rows.all())
+
+    result = await db.execute(
+        select(Vulnerability).options(
+            selectinload(Vulnerability.device),
+            raiseload("*")
+        ).where(
+            Vulnerability.device_id == device_id,
+            Vulnerability.deleted_at.is_(None)
+        ).order_by(
+            Vulnerability.severity_score.desc(),
+            Vulnerability.detected_at.desc()
+        ).offset(offset).limit(limit)
+    )
+    vulnerabilities = result.scalars().all()
+
+    # Group the current page by severity. Binding the append methods up front
+    # avoids a dict hash + list attribute lookup per row, and an unexpected
+    # severity falls back to the info bucket instead of raising KeyError
+    grouped_vulns = {level: [] for level in SEVERITY_LEVELS}
+    append_for = {level: bucket.append for level, bucket in grouped_vulns.items()}
+    info_append = append_for["info"]
+
     for vuln in vulnerabilities:
-        vuln_data = {
-            "id": vuln.id,
-            "title": vuln.title,
-            "cve_id": vuln.cve_id,
-            "cvss_score": vuln.cvss_score,
-            "source_tool": vuln.source_tool,
-            "detected_at": vuln.detected_at,
-            "affected_port": vuln.affected_port,
-            "affected_service": vuln.affected_service,
-            "solution": vuln.solution
-        }
-        grouped_vulns[vuln.severity].append(vuln_data)
-    
+        append_for.get(vuln.severity, info_append)(vuln_to_dict(vuln))
+
     return {
         "device": {
             "id": device.id,
@@ -257,50 +321,74 @@ async def get_device_vulnerabilities(
             "risk_level": device.risk_level
         },
         "vulnerability_summary": {
-            "total": len(vulnerabilities),
-            "critical": len(grouped_vulns["critical"]),
-            "high": len(grouped_vulns["high"]),
-            "medium": len(grouped_vulns["medium"]),
-            "low": len(grouped_vulns["low"]),
-            "info": len(grouped_vulns["info"])
+            "total": sum(severity_counts.values()),
+            "critical": severity_counts.get("critical", 0),
+            "high": severity_counts.get("high", 0),
+            "medium": severity_counts.get("medium", 0),
+            "low": severity_counts.get("low", 0),
+            "info": severity_counts.get("info", 0)
         },
+        "returned_count": len(vulnerabilities),
         "vulnerabilities": grouped_vulns
     }
 
 @router.post("/{vulnerability_id}/mark-resolved")
 async def mark_vulnerability_resolved(
     vulnerability_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     resolution_note: Optional[str] = None
 ):
     """Mark a vulnerability as resolved"""
-    
-    vulnerability = db.query(Vulnerability).filter(Vulnerability.id == vulnerability_id).first()
-    if not vulnerability:
-        raise HTTPException(status_code=404, detail="Vulnerability not found")
-    
-    # In a real implementation, you might add a 'resolved' field to the Vulnerability model
-    # For now, we'll just return success
-    
+
+    # Single UPDATE ... RETURNING: persists the resolution, checks existence
+    # and is idempotent (an already-resolved row matches nothing)
+    resolved_at = await db.scalar(
+        update(Vulnerability)
+        .where(
+            Vulnerability.id == vulnerability_id,
+            Vulnerability.deleted_at.is_(None),
+            Vulnerability.resolved_at.is_(None)
+        )
+        .values(resolved_at=func.now(), resolution_note=resolution_note)
+        .returning(Vulnerability.resolved_at)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+
+    if resolved_at is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Vulnerability not found or already resolved"
+        )
+
     return {
         "message": "Vulnerability marked as resolved",
         "vulnerability_id": vulnerability_id,
         "resolution_note": resolution_note,
-        "resolved_at": datetime.utcnow()
+        "resolved_at": resolved_at
     }
 
 @router.delete("/{vulnerability_id}")
 async def delete_vulnerability(
     vulnerability_id: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Delete a vulnerability"""
-    
-    vulnerability = db.query(Vulnerability).filter(Vulnerability.id == vulnerability_id).first()
-    if not vulnerability:
+    """Soft-delete a vulnerability"""
+
+    # Single UPDATE instead of SELECT + DELETE + cascade traversal; the
+    # rowcount doubles as the existence check
+    result = await db.execute(
+        update(Vulnerability)
+        .where(
+            Vulnerability.id == vulnerability_id,
+            Vulnerability.deleted_at.is_(None)
+        )
+        .values(deleted_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+
+    if not result.rowcount:
         raise HTTPException(status_code=404, detail="Vulnerability not found")
-    
-    db.delete(vulnerability)
-    db.commit()
-    
-    return {"message": "Vulnerability deleted successfully"}
\ No newline at end of file
+
+    return {"message": "Vulnerability deleted successfully"}
@@ -0,0 +1,66 @@
+"""
+Vulnerability API schemas
+"""
+
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel, ConfigDict, model_validator
+
+
+def vuln_to_dict(vuln) -> dict:
+    """Build the response dict for a vulnerability with its joined device"""
+    device = vuln.device
+    return {
+        "id": vuln.id,
+        "cve_id": vuln.cve_id,
+        "title": vuln.title,
+        "description": vuln.description,
+        "severity": vuln.severity,
+        "cvss_score": vuln.cvss_score,
+        "source_tool": vuln.source_tool,
+        "detected_at": vuln.detected_at,
+        "affected_port": vuln.affected_port,
+        "affected_service": vuln.affected_service,
+        "solution": vuln.solution,
+        "references": vuln.reference_list,
+        "device_id": vuln.device_id,
+        "device_ip": device.ip_address if device else "Unknown",
+        "device_hostname": device.hostname if device else None,
+        "scan_session_id": vuln.scan_session_id
+    }
+
+
+class VulnerabilityResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: str
+    cve_id: Optional[str] = None
+    title: str
+    description: Optional[str] = None
+    severity: str
+    cvss_score: Optional[float] = None
+    source_tool: Optional[str] = None
+    detected_at: Optional[datetime] = None
+    affected_port: Optional[int] = None
+    affected_service: Optional[str] = None
+    solution: Optional[str] = None
+    references: List[str] = []
+    device_id: Optional[str] = None
+    device_ip: str = "Unknown"
+    device_hostname: Optional[str] = None
+    scan_session_id: Optional[str] = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def _flatten_orm(cls, value):
+        """Pull references and the joined device's fields off the ORM object"""
+        if isinstance(value, dict):
+            return value
+        return vuln_to_dict(value)
+
+
+class VulnerabilityListResponse(BaseModel):
+    vulnerabilities: List[VulnerabilityResponse]
+    total_count: int
+    returned_count: int